@@ -1,9 +1,14 @@
+import argparse
+import copy
 import random
+from collections import deque
 import numpy as np
 import torch
 import torch.nn as nn
 import torch.optim as optim
-from collections import deque
+from torch.nn import functional as F
+from torch.func import stack_module_state, functional_call
+from numba import njit
 import matplotlib.pyplot as plt
 from matplotlib import colors
 from matplotlib.patches import Rectangle
@@ -15,16 +20,103 @@ GRID_ROWS = 8           # 网格行数
 GRID_COLS = 8           # 网格列数
 NUM_AGENTS = 4          # 智能体个数
 NUM_EPISODES = 400      # 训练轮数
+NUM_ENVS = 8            # 并行环境个数
 
 # ----------------------------------------
 # 第一部分：定义 TrafficRoutingEnv 环境（加入固定障碍物）
 # ----------------------------------------
+# 动作 0=上、1=下、2=左、3=右、4=停留 对应的坐标增量
+DX = np.array([-1, 1, 0, 0, 0], dtype=np.int64)
+DY = np.array([0, 0, -1, 1, 0], dtype=np.int64)
+
+
+@njit(cache=True)
+def _step_single(pos, arrived, actions, next_cell, W):
+    """
+    单个环境的状态转移：查表得到期望新位置，处理交换碰撞与同格碰撞，
+    并把最终位置原地写回 pos（形状 [N, 2]）。返回本步碰撞的智能体数。
+    所有位置都按展平下标 cell = x * W + y 处理，next_cell[cell, a] 为执行动作 a 后的格子。
+    """
+    N = pos.shape[0]
+
+    # 1. 查表得到“期望”新位置（越界/障碍物已在表中处理为原地不动，已到达的冻结）
+    old_flat = np.empty(N, dtype=np.int32)
+    new_flat = np.empty(N, dtype=np.int32)
+    for i in range(N):
+        old_flat[i] = pos[i, 0] * W + pos[i, 1]
+        if arrived[i]:
+            new_flat[i] = old_flat[i]
+        else:
+            new_flat[i] = next_cell[old_flat[i], actions[i]]
+
+    # 2. 检测并标记“交换碰撞”：按旧位置把智能体挂到各格子的链表上（head[cell] -> nxt[i] -> ...），
+    #    每个智能体只需检查目标格子上原来的占据者是否正好要走到自己的旧位置，整体 O(N)。
+    #    起点可能重合，所以一个格子上可以有多个占据者
+    num_cells = next_cell.shape[0]
+    head = np.full(num_cells, -1, dtype=np.int32)
+    nxt = np.empty(N, dtype=np.int32)
+    for i in range(N):
+        nxt[i] = head[old_flat[i]]
+        head[old_flat[i]] = i
+    swap_blocked = np.zeros(N, dtype=np.bool_)
+    for i in range(N):
+        j = head[new_flat[i]]
+        while j != -1:
+            if j != i and new_flat[j] == old_flat[i]:
+                swap_blocked[i] = True
+                swap_blocked[j] = True
+            j = nxt[j]
+
+    # 3. 检测“同格碰撞”：desired[cell] 为 -1 表示无人，>=0 为唯一申请者，-2 表示多人争抢
+    desired = np.full(num_cells, -1, dtype=np.int32)
+    for i in range(N):
+        if swap_blocked[i]:
+            continue
+        cell = new_flat[i]
+        if desired[cell] == -1:
+            desired[cell] = i
+        else:
+            desired[cell] = -2
+
+    # 4. 被阻塞的智能体退回原位，其余写入新位置
+    num_collisions = 0
+    for i in range(N):
+        if swap_blocked[i] or desired[new_flat[i]] == -2:
+            num_collisions += 1
+        else:
+            pos[i, 0] = new_flat[i] // W
+            pos[i, 1] = new_flat[i] % W
+    return num_collisions
+
+
+@njit(cache=True)
+def _step_kernel(pos, arrived, actions, next_cell, W):
+    """
+    K 个并行环境的状态转移：pos 形状 [K, N, 2]，arrived / actions 形状 [K, N]。
+    返回每个环境本步的碰撞次数，形状 [K]。
+    """
+    K = pos.shape[0]
+    num_collisions = np.zeros(K, dtype=np.int64)
+    for k in range(K):
+        num_collisions[k] = _step_single(pos[k], arrived[k], actions[k], next_cell, W)
+    return num_collisions
+
+
 class TrafficRoutingEnv:
-    def __init__(self, grid_size=(5, 5), num_agents=2, obstacles=None):
+    # render 用的 colormap 在类级别只构造一次：0 空白、1 目标、2 智能体、3 障碍物
+    _render_cmap = colors.ListedColormap(['white', 'blue', 'red', 'black'])
+    _render_bounds = [0, 1, 2, 3, 4]
+    _render_norm = colors.BoundaryNorm(_render_bounds, _render_cmap.N)
+    # 同一套颜色的 uint8 RGB 调色板，rgb_array 模式下直接查表，不经过 matplotlib 绘图
+    _render_palette = (colors.to_rgba_array(_render_cmap.colors)[:, :3] * 255).astype(np.uint8)
+
+    def __init__(self, grid_size=(5, 5), num_agents=2, obstacles=None, num_envs=1):
         """
         新增参数：
             obstacles: List of (row, col) 坐标，表示固定不可通过的障碍物。
                        如果为 None，则默认没有障碍物。
+            num_envs: 并行运行的环境副本数 K。所有副本共享起点、目的地和障碍物，
+                      step 一次推进全部 K 个副本，以摊薄 Python 调用开销。
         """
         # 设置随机种子，确保可复现
         random.seed(41)
@@ -33,26 +125,26 @@ class TrafficRoutingEnv:
 
         self.grid_size = grid_size
         self.num_agents = num_agents
+        self.num_envs = num_envs
 
-        # ① 只在初始化时随机生成一套起点，并把它存下来
-        self._initial_positions = {
-            i: (np.random.randint(self.grid_size[0]),
-                np.random.randint(self.grid_size[1]))
-            for i in range(self.num_agents)
-        }
+        # ① 只在初始化时随机生成一套起点，并把它存下来（[N, 2] 的 int16 数组）
+        self._init_pos = np.array([
+            (np.random.randint(self.grid_size[0]), np.random.randint(self.grid_size[1]))
+            for _ in range(self.num_agents)
+        ], dtype=np.int16).reshape(self.num_agents, 2)
         # ② 目的地在初始化时生成并保持不变
-        self.destinations = {
-            i: (np.random.randint(self.grid_size[0]),
-                np.random.randint(self.grid_size[1]))
-            for i in range(self.num_agents)
-        }
+        self._dest = np.array([
+            (np.random.randint(self.grid_size[0]), np.random.randint(self.grid_size[1]))
+            for _ in range(self.num_agents)
+        ], dtype=np.int16).reshape(self.num_agents, 2)
 
-        # ③ 第一次“真正地”把 agent_positions 设为初始的那份
-        self.agent_positions = dict(self._initial_positions)
+        # ③ 当前位置为 [K, N, 2]，供 _step_kernel 直接原地更新
+        self._pos = np.repeat(self._init_pos[None], self.num_envs, axis=0)
+        self._old_pos = np.empty_like(self._pos)
 
-        # ④ 初始化 arrived 标记和步数
-        self._arrived = {i: False for i in range(self.num_agents)}
-        self.steps = 0
+        # ④ 初始化 arrived 标记和步数（每个并行环境各自计数）
+        self._arrived = np.zeros((self.num_envs, self.num_agents), dtype=np.bool_)
+        self.steps = np.zeros(self.num_envs, dtype=np.int64)
 
         # ⑤ 初始化障碍物列表
         if obstacles is None:
@@ -60,149 +152,164 @@ class TrafficRoutingEnv:
         else:
             self.obstacles = obstacles.copy()
 
+        # 障碍物坐标必须在网格内（负下标会被 numpy 当作从末尾倒数，不能直接写入掩码）
+        for ob in self.obstacles:
+            if not (0 <= ob[0] < self.grid_size[0] and 0 <= ob[1] < self.grid_size[1]):
+                raise ValueError(f"障碍物 {tuple(ob)} 超出网格范围 {tuple(self.grid_size)}！")
+
+        # ⑥ 障碍物掩码：_obs_mask[x, y] 为 True 表示该格不可通过，构造后只需 O(1) 查表
+        self._obs_mask = np.zeros(self.grid_size, dtype=np.bool_)
+        if self.obstacles:
+            self._obs_mask[tuple(zip(*self.obstacles))] = True
+
         # 确保障碍物不会与初始位置或目的地冲突
-        for obs in self.obstacles:
-            for i in range(self.num_agents):
-                if obs == self._initial_positions[i]:
-                    raise ValueError(f"障碍物 {obs} 与 Agent {i} 的初始位置冲突！")
-                if obs == self.destinations[i]:
-                    raise ValueError(f"障碍物 {obs} 与 Agent {i} 的目的地冲突！")
-
-    def reset(self):
+        for i in range(self.num_agents):
+            if self._obs_mask[tuple(self._init_pos[i])]:
+                raise ValueError(f"障碍物 {tuple(self._init_pos[i].tolist())} 与 Agent {i} 的初始位置冲突！")
+            if self._obs_mask[tuple(self._dest[i])]:
+                raise ValueError(f"障碍物 {tuple(self._dest[i].tolist())} 与 Agent {i} 的目的地冲突！")
+
+        # ⑦ 网格和障碍物固定，(格子, 动作) -> 下一格 是纯查表：_next[x * W + y, a]，
+        #    越界或撞到障碍物时下一格就是原格子
+        H, W = self.grid_size
+        cells = np.arange(H * W)
+        cx, cy = np.divmod(cells, W)
+        nx = cx[:, None] + DX  # [H*W, 5]
+        ny = cy[:, None] + DY
+        movable = (nx >= 0) & (nx < H) & (ny >= 0) & (ny < W)
+        movable[movable] = ~self._obs_mask[nx[movable], ny[movable]]
+        self._next = np.where(movable, nx * W + ny, cells[:, None]).astype(np.int32)
+
+        # ⑧ 构造 state 用的预分配缓冲区（14 维 = 4坐标 + 9邻居 + 1归一化曼哈顿距离）
+        self._state_buf = np.zeros((self.num_envs, self.num_agents, 14), dtype=np.float32)
+        self._coord_denom = np.array([H - 1, W - 1], dtype=np.float64)
+        self._dist_denom = (H - 1) + (W - 1)  # 最大可能曼哈顿距离
+        # 外围补一圈的占据网格，3x3 邻域直接切片即可，无需边界判断；
+        # 外圈固定为 1，即把网格边界之外视作“占据”（与障碍物一样不可进入）
+        self._padded = np.ones((self.num_envs, H + 2, W + 2), dtype=np.float32)
+        # 3x3 邻域相对于 padded 中左上角 (x, y) 的行/列偏移，按行优先展开成 9 维
+        self._nbr_dx, self._nbr_dy = np.divmod(np.arange(9), 3)
+        self._env_idx = np.arange(self.num_envs)[:, None]  # [K, 1]，用于按环境索引
+
+        # ⑨ step 用的预分配奖励缓冲区，形状 [K, N]
+        self._raw_r = np.empty((self.num_envs, self.num_agents), dtype=np.float32)
+        self._shaped_r = np.empty((self.num_envs, self.num_agents), dtype=np.float32)
+
+    @property
+    def agent_positions(self):
+        # 以 {agent_id: (row, col)} 的形式对外提供第 0 个环境的当前位置
+        return {i: (int(x), int(y)) for i, (x, y) in enumerate(self._pos[0])}
+
+    @property
+    def destinations(self):
+        # 以 {agent_id: (row, col)} 的形式对外提供各智能体的目的地
+        return {i: (int(x), int(y)) for i, (x, y) in enumerate(self._dest)}
+
+    def reset(self, env_mask=None):
         """
-        不再随机生成位置，而是把 agent_positions 还原为构造时那套 _initial_positions，
+        不再随机生成位置，而是把 agent_positions 还原为构造时那套初始位置 _init_pos，
         并把 arrived、steps 清零。目的地 self.destinations 和 self.obstacles 保持不变。
+        env_mask: 形状 [K] 的 bool 数组，只复位其中为 True 的环境；为 None 时复位全部。
         """
+        if env_mask is None:
+            env_mask = slice(None)
+
         # 1) 把 agent_locations 复位到构造里存的那份
-        self.agent_positions = dict(self._initial_positions)
+        self._pos[env_mask] = self._init_pos
 
         # 2) 清空 arrived 标志，步数归零
-        self._arrived = {i: False for i in range(self.num_agents)}
-        self.steps = 0
+        self._arrived[env_mask] = False
+        self.steps[env_mask] = 0
 
-        # 3) 返回当前（复位后）的观测
-        return self._get_observations()
+        # 3) 返回当前（复位后）的观测，即所有环境、所有智能体的 state，形状 [K, N, 14]
+        return self._build_states()
 
-    def _get_observations(self):
-        # 返回每个智能体的当前位置、目标位置，以及障碍物列表（如需将障碍物信息纳入 observation）
-        obs = {}
-        for i in range(self.num_agents):
-            obs[i] = {
-                'position': self.agent_positions[i],
-                'destination': self.destinations[i],
-                # 如果后续算法需要知道分布式障碍，可在 observation 中加入：
-                'obstacles': self.obstacles
-            }
-        return obs
-
-    def step(self, actions):
-        # 1. 记录旧位置
-        old_positions = {i: self.agent_positions[i] for i in range(self.num_agents)}
-
-        # 2. 计算“期望”新位置（含已到达冻结逻辑 + 障碍物阻塞逻辑）
-        new_positions = {}
-        for i, action in actions.items():
-            if self._arrived.get(i, False):
-                new_positions[i] = old_positions[i]
-                continue
-
-            x, y = old_positions[i]
-            if action == 0 and x > 0:                  # 上
-                x -= 1
-            elif action == 1 and x < self.grid_size[0] - 1:  # 下
-                x += 1
-            elif action == 2 and y > 0:                # 左
-                y -= 1
-            elif action == 3 and y < self.grid_size[1] - 1:  # 右
-                y += 1
-            # action == 4 (停留) 或越界时，x,y 保持不变
-
-            # 如果“期望”新位置是障碍物，则保持在原地
-            if (x, y) in self.obstacles:
-                new_positions[i] = old_positions[i]
-            else:
-                new_positions[i] = (x, y)
-
-        # 3. 检测并标记“交换碰撞”
-        swap_blocked = set()
-        for i in range(self.num_agents):
-            for j in range(i + 1, self.num_agents):
-                if (new_positions[i] == old_positions[j]
-                        and new_positions[j] == old_positions[i]):
-                    swap_blocked.add(i)
-                    swap_blocked.add(j)
-
-        # 4. 检测并标记“同格碰撞”
-        from collections import defaultdict
-        desired_cells = defaultdict(list)
-        for i in range(self.num_agents):
-            if i in swap_blocked:
-                continue
-            desired_cells[new_positions[i]].append(i)
+    def _build_states(self):
+        """
+        一次性构造所有环境、所有智能体的 state，形状 [K, N, 14]，同时把障碍物与其他智能体视作占据单元。
+        注意：返回的是环境内部复用的缓冲区，下一次 reset/step 会覆盖其内容，需要保存时请先 copy。
+        """
+        buf = self._state_buf
+        kk = self._env_idx
+        px, py = self._pos[..., 0], self._pos[..., 1]
+
+        # 4 维归一化坐标
+        buf[..., 0:2] = self._pos / self._coord_denom
+        buf[..., 2:4] = self._dest / self._coord_denom
 
-        collision_blocked = set()
-        for cell, agents in desired_cells.items():
-            if len(agents) > 1:
-                for a in agents:
-                    collision_blocked.add(a)
+        # occupancy 标记网格中哪些位置被“占据”——障碍物或智能体；越界部分为 1。
+        # 每步只重写内部区域，外圈保持不变
+        padded = self._padded
+        padded[:, 1:-1, 1:-1] = self._obs_mask
+        padded[kk, px + 1, py + 1] = 1.0
 
-        # 统计碰撞次数
-        num_collisions = len(swap_blocked) + len(collision_blocked)
+        # 3x3 邻居信息，9 维
+        buf[..., 4:13] = padded[kk[..., None], px[..., None] + self._nbr_dx, py[..., None] + self._nbr_dy]
 
-        # 5. 合并所有需要阻塞的智能体
-        blocked = swap_blocked.union(collision_blocked)
+        # 归一化曼哈顿距离
+        dist = np.abs(self._pos - self._dest).sum(axis=-1)
+        buf[..., 13] = dist / self._dist_denom
+        return buf
 
-        # 6. 决定每个智能体的最终位置
-        final_positions = {}
-        for i in range(self.num_agents):
-            if i in blocked:
-                final_positions[i] = old_positions[i]
-            else:
-                final_positions[i] = new_positions[i]
+    def step(self, actions, autoreset=False):
+        """
+        actions: 形状 [K, N] 的整数数组。
+        返回 (states [K, N, 14], shaped_rewards [K, N], done [K], info, num_collisions [K])，
+        其中 states 与 shaped_rewards 是环境内部复用的缓冲区。
+        autoreset=True 时，本步结束的环境会被原地复位，返回的 states 中对应行是复位后的观测，
+        复位前的最终观测保存在 info['final_states'] 中（供存入回放缓冲）。
+        """
+        W = self.grid_size[1]
+        K, N = self.num_envs, self.num_agents
 
-        # 更新位置
-        self.agent_positions = final_positions
+        # 1. 记录旧位置
+        np.copyto(self._old_pos, self._pos)
+        action_arr = np.asarray(actions, dtype=np.int64).reshape(K, N)
+        # kernel 里查 _next 表时不做越界检查，非法动作必须在这里拦下
+        if ((action_arr < 0) | (action_arr > 4)).any():
+            raise ValueError(f"非法动作 {np.unique(action_arr[(action_arr < 0) | (action_arr > 4)]).tolist()}，"
+                             f"动作编号必须在 0~4 之间")
+
+        # 2~6. 期望位置、交换碰撞、同格碰撞以及最终位置都在 _step_kernel 中完成，
+        #      self._pos 被原地更新，返回值即各环境本步碰撞次数
+        num_collisions = _step_kernel(self._pos, self._arrived, action_arr, self._next, W)
         self.steps += 1
 
-        # 7. 计算原始奖励和 dones（到达目标 +10，否则 -1）
-        raw_rewards = {}
-        dones = {}
-        for i in range(self.num_agents):
-            if self.agent_positions[i] == self.destinations[i]:
-                if not self._arrived[i]:
-                    raw_rewards[i] = +10
-                    self._arrived[i] = True
-                else:
-                    raw_rewards[i] = 0
-                dones[i] = True
-            else:
-                raw_rewards[i] = -1
-                dones[i] = False
-
-        # 8. 利用“旧距离 / 新距离”做潜力塑形，计算最终奖励
-        shaped_rewards = {}
-        gamma = 0.99
-        for i in range(self.num_agents):
-            ox, oy = old_positions[i]
-            gx, gy = self.destinations[i]
-            dist_old = abs(ox - gx) + abs(oy - gy)
+        # 7. 计算原始奖励和 dones（首次到达目标 +10，之后停在目标 0，否则 -1）
+        dones = (self._pos == self._dest).all(axis=-1)  # [K, N]
+        self._raw_r[:] = -1.0
+        self._raw_r[dones] = 0.0
+        self._raw_r[dones & ~self._arrived] = 10.0
+        self._arrived |= dones
 
-            nx, ny = self.agent_positions[i]
-            dist_new = abs(nx - gx) + abs(ny - gy)
+        # 8. 利用“旧距离 / 新距离”做潜力塑形，计算最终奖励：raw + (γ·φ_new − φ_old)，φ = −曼哈顿距离
+        gamma = 0.99
+        dist_old = np.abs(self._old_pos - self._dest).sum(axis=-1)
+        dist_new = np.abs(self._pos - self._dest).sum(axis=-1)
+        # 先在 float64 中计算再写入 float32 缓冲区
+        self._shaped_r[:] = self._raw_r + (gamma * -dist_new + dist_old)
+        shaped_rewards = self._shaped_r
 
-            phi_old = -dist_old
-            phi_new = -dist_new
+        # 9. 回合结束标志
+        done = dones.all(axis=1) | (self.steps >= 50)
+        states = self._build_states()
 
-            # 下面这行强制转成 float32
-            reward32 = np.float32(raw_rewards[i] + (gamma * phi_new - phi_old))
-            shaped_rewards[i] = reward32
+        # 10. 自动复位已结束的环境
+        info = {}
+        if autoreset and done.any():
+            info['final_states'] = states.copy()
+            states = self.reset(done)
+        return states, shaped_rewards, done, info, num_collisions
 
-        # 9. 回合结束标志
-        done = all(dones.values()) or (self.steps >= 50)
-        return self._get_observations(), shaped_rewards, done, {}, num_collisions
+    def render(self, env_index=0, mode='human'):
+        """
+        可视化网格、障碍物、智能体和目标（默认展示第 0 个并行环境）。
+        mode='human' 用 matplotlib 弹窗显示；mode='rgb_array' 不创建任何图形，
+        直接返回 [H, W, 3] 的 uint8 图像，适合在循环中调用。
+        """
+        if mode not in ('human', 'rgb_array'):
+            raise ValueError(f"未知的 render 模式: {mode}")
 
-    def render(self):
-        # 可视化网格、障碍物、智能体和目标
         H, W = self.grid_size
         grid = np.zeros((H, W), dtype=int)
 
@@ -210,32 +317,29 @@ class TrafficRoutingEnv:
         # 1 表示目标（蓝色）
         # 2 表示智能体（红色）
         # 3 表示障碍物（黑色）
-        for (ox, oy) in self.obstacles:
-            grid[ox, oy] = 3
+        grid[self._obs_mask] = 3
 
         for i in range(self.num_agents):
-            x, y = self.destinations[i]
+            x, y = self._dest[i].tolist()
             # 如果目的地恰好在障碍物上，根据需求可抛出错误或忽略。此处假设不冲突：
             if grid[x, y] == 3:
                 raise ValueError(f"目的地 {(x, y)} 与障碍物冲突！")
             grid[x, y] = 1  # 目标标蓝色
 
         for i in range(self.num_agents):
-            x, y = self.agent_positions[i]
+            x, y = self._pos[env_index, i].tolist()
             # 如果智能体恰好踩在障碍物上，说明逻辑有问题，此处抛出错误以便调试
             if grid[x, y] == 3:
                 raise ValueError(f"Agent {i} 企图进入障碍物 {(x, y)}！")
             # 如果目的地和智能体重叠，根据优先级，智能体覆盖目标
             grid[x, y] = 2  # 智能体标红色
 
-        # 定义带四种颜色的 colormap
-        cmap = colors.ListedColormap(['white', 'blue', 'red', 'black'])
-        bounds = [0, 1, 2, 3, 4]
-        norm = colors.BoundaryNorm(bounds, cmap.N)
+        if mode == 'rgb_array':
+            return self._render_palette[grid]
 
         plt.figure(figsize=(5, 5))
-        plt.imshow(grid, cmap=cmap, norm=norm)
-        plt.title(f"Step: {self.steps}")
+        plt.imshow(grid, cmap=self._render_cmap, norm=self._render_norm)
+        plt.title(f"Step: {self.steps[env_index]}")
         plt.show()
 
 
@@ -259,75 +363,99 @@ class DQN(nn.Module):
 
 # 2. 经验回放缓冲区
 class ReplayBuffer:
-    def __init__(self, capacity):
-        self.capacity = capacity
-        self.buffer = deque(maxlen=capacity)
-
-    def push(self, state, action, reward, next_state, done):
-        self.buffer.append((state, action, reward, next_state, done))
-
-    def sample(self, batch_size):
-        batch = random.sample(self.buffer, batch_size)
-        state, action, reward, next_state, done = map(np.array, zip(*batch))
-        return state, action, reward, next_state, done
-
-    def __len__(self):
-        return len(self.buffer)
-
-# 3. 辅助函数：将观测转换为网络输入的 state 向量
-def obs_to_state(obs, grid_size):
     """
-    扩展状态：在 14 维（4坐标+9邻居+1归一化曼哈顿距离）的基础上，
-    同时将障碍物也视作占据单元。
-    最终 state 维度：14。
+    所有智能体共用的环形缓冲区：各字段预分配为 [num_agents, capacity, ...] 的张量，
+    每次 push 写入 K 个并行环境同一步里所有智能体的 transition，sample 时各智能体独立随机抽样。
+    所有张量直接分配在训练设备上，采样结果无需再做主机到设备的拷贝；
+    使用 GPU 时，push 的 numpy 数据先写入锁页内存，再异步拷贝到 device。
     """
-    state_dict = {}
-    H, W = grid_size
-    # occupancy 标记网格中哪些位置被“占据”——智能体或障碍物
-    occupancy = np.zeros((H, W), dtype=np.float32)
-    # 先把障碍物设为占据
-    if 'obstacles' in next(iter(obs.values())):
-        for (ox, oy) in next(iter(obs.values()))['obstacles']:
-            occupancy[ox, oy] = 1.0
-
-    # 再把所有智能体设为占据
-    for j in range(len(obs)):
-        rx, ry = obs[j]['position']
-        occupancy[rx, ry] = 1.0
-
-    for agent_id, info in obs.items():
-        x, y = info['position']
-        dx, dy = info['destination']
-
-        # 4 维归一化坐标
-        pos_vec = np.array([x/(H-1), y/(W-1), dx/(H-1), dy/(W-1)], dtype=np.float32)
-
-        # 3x3 邻居信息
-        local = np.zeros((3, 3), dtype=np.float32)
-        for dx_off in (-1, 0, 1):
-            for dy_off in (-1, 0, 1):
-                nx, ny = x + dx_off, y + dy_off
-                if 0 <= nx < H and 0 <= ny < W:
-                    local[dx_off+1, dy_off+1] = occupancy[nx, ny]
-        local_flat = local.flatten()  # 9 维
-
-        # 归一化曼哈顿距离
-        dist = abs(x - dx) + abs(y - dy)
-        # 最大可能距离约为 (H-1)+(W-1)，所以归一化为 [0,1]
-        dist_norm = np.array([dist / ((H - 1) + (W - 1))], dtype=np.float32)
-
-        # 拼接：4 + 9 + 1 = 14 维
-        state = np.concatenate([pos_vec, local_flat, dist_norm], axis=0)
-        state_dict[agent_id] = state
-
-    return state_dict
+    def __init__(self, capacity, num_agents, state_dim, device='cpu'):
+        self.capacity = capacity
+        self.device = torch.device(device)
+        self.states = torch.empty((num_agents, capacity, state_dim), dtype=torch.float32, device=self.device)
+        self.actions = torch.empty((num_agents, capacity), dtype=torch.long, device=self.device)
+        self.rewards = torch.empty((num_agents, capacity), dtype=torch.float32, device=self.device)
+        self.next_states = torch.empty((num_agents, capacity, state_dim), dtype=torch.float32, device=self.device)
+        self.dones = torch.empty((num_agents, capacity), dtype=torch.float32, device=self.device)
+        self._agent_idx = torch.arange(num_agents, device=self.device).unsqueeze(1)  # [A, 1]，用于按智能体索引
+        self._agent_offset = self._agent_idx * capacity  # [A, 1]，展平成 [A*capacity] 后各智能体的起始下标
+        self.ptr, self.size = 0, 0
+        # 锁页暂存区（按字段名懒分配）以及上一次异步拷贝完成的事件，仅 GPU 时使用
+        self._staging = {} if self.device.type == 'cuda' else None
+        self._staging_done = None
+
+    def _to_device(self, name, arr):
+        """把一个 numpy 数组拷贝到 device；GPU 上经由锁页暂存区做 non_blocking 拷贝"""
+        arr = np.asarray(arr)
+        if self._staging is None:
+            return torch.as_tensor(arr, device=self.device)
+        buf = self._staging.get(name)
+        if buf is None or buf.shape != arr.shape:
+            buf = torch.empty(arr.shape, dtype=torch.from_numpy(arr).dtype, pin_memory=True)
+            self._staging[name] = buf
+        buf.numpy()[...] = arr
+        return buf.to(self.device, non_blocking=True)
+
+    def push(self, states, actions, rewards, next_states, dones):
+        # 各参数前两维为 [K, num_agents]，一次写入 K 个槽位（满了则覆盖最旧的数据）
+        if self._staging_done is not None:
+            self._staging_done.synchronize()  # 上一次的异步拷贝完成后才能覆盖暂存区
+        k = len(states)
+        idx = (self.ptr + torch.arange(k, device=self.device)) % self.capacity
+        self.states[:, idx] = self._to_device('states', states).transpose(0, 1)
+        self.actions[:, idx] = self._to_device('actions', actions).transpose(0, 1)
+        self.rewards[:, idx] = self._to_device('rewards', rewards).transpose(0, 1)
+        self.next_states[:, idx] = self._to_device('next_states', next_states).transpose(0, 1)
+        self.dones[:, idx] = self._to_device('dones', dones).transpose(0, 1).float()
+        if self._staging is not None:
+            self._staging_done = torch.cuda.Event()
+            self._staging_done.record()
+        self.ptr = (self.ptr + k) % self.capacity
+        self.size = min(self.size + k, self.capacity)
+
+    def empty_batch(self, batch_size):
+        """
+        分配一组可供 sample(out=...) 反复写入的张量：
+        states / next_states 为 [A, B, state_dim]，actions / rewards / dones 为 [A, B, 1]
+        """
+        num_agents, _, state_dim = self.states.shape
+        shape = (num_agents, batch_size)
+        return (torch.empty((*shape, state_dim), dtype=torch.float32, device=self.device),
+                torch.empty((*shape, 1), dtype=torch.long, device=self.device),
+                torch.empty((*shape, 1), dtype=torch.float32, device=self.device),
+                torch.empty((*shape, state_dim), dtype=torch.float32, device=self.device),
+                torch.empty((*shape, 1), dtype=torch.float32, device=self.device))
+
+    def sample(self, batch_size, out=None):
+        """
+        每个智能体各自抽 batch_size 个下标，返回 (states, actions, rewards, next_states, dones)，
+        形状同 empty_batch。out 为 empty_batch 分配的张量时结果直接写入其中，不再分配新的张量。
+        """
+        if out is None:
+            out = self.empty_batch(batch_size)
+        idx = torch.randint(0, self.size, (self._agent_idx.shape[0], batch_size), device=self.device)
+
+        # 把 [A, capacity, ...] 展平成 [A*capacity, ...]，用一维下标一次性取出所有智能体的样本
+        flat_idx = idx.add_(self._agent_offset).view(-1)
+        fields = (self.states, self.actions, self.rewards, self.next_states, self.dones)
+        for src, dst in zip(fields, out):
+            src_flat = src.view(-1, *src.shape[2:])
+            torch.index_select(src_flat, 0, flat_idx, out=dst.view(-1, *src.shape[2:]))
+        return out
 
+    def __len__(self):
+        return self.size
 
-# 4. 多智能体 DQN 训练器
+# 3. 多智能体 DQN 训练器
 class MADQNTrainer:
     def __init__(self, env, num_agents, state_dim, action_dim,
                  buffer_capacity=5000, batch_size=64,
-                 gamma=0.99, lr=1e-3, target_update=10):
+                 gamma=0.99, lr=1e-3, target_update=10, loss_type='huber',
+                 use_compile=None):
+        """
+        use_compile: 是否用 torch.compile 编译前向+损失。默认 None 表示只在 CUDA 上编译：
+                     CPU 上编译耗时远超训练中省下的时间；编译失败时自动退回 eager 模式。
+        """
         self.env = env
         self.num_agents = num_agents
         self.state_dim = state_dim
@@ -336,93 +464,163 @@ class MADQNTrainer:
         self.gamma = gamma
         self.target_update = target_update
 
-        # 为每个智能体分别创建策略网络、目标网络、优化器和回放缓冲区
-        self.policy_nets = {}
-        self.target_nets = {}
-        self.optimizers = {}
-        self.replay_buffers = {}
-
-        for i in range(num_agents):
-            policy_net = DQN(state_dim, action_dim)
-            target_net = DQN(state_dim, action_dim)
-            target_net.load_state_dict(policy_net.state_dict())
-            optimizer = optim.Adam(policy_net.parameters(), lr=lr)
-            buffer = ReplayBuffer(buffer_capacity)
-
-            self.policy_nets[i] = policy_net
-            self.target_nets[i] = target_net
-            self.optimizers[i] = optimizer
-            self.replay_buffers[i] = buffer
+        # TD 误差的损失函数：'huber'（smooth L1，DQN 常用，更稳定）或 'mse'
+        if loss_type == 'huber':
+            self.loss_fn = F.smooth_l1_loss
+        elif loss_type == 'mse':
+            self.loss_fn = F.mse_loss
+        else:
+            raise ValueError(f"未知的 loss_type: {loss_type}")
+        self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+        # 为每个智能体创建一份 DQN，再把参数沿第 0 维堆叠成一个 ensemble：
+        # policy_params / target_params 中每个张量的形状都是 [num_agents, ...]
+        policy_models = [DQN(state_dim, action_dim).to(self.device) for _ in range(num_agents)]
+        self.policy_params, _ = stack_module_state(policy_models)
+        self.target_params = {k: v.detach().clone() for k, v in self.policy_params.items()}
+        # 同顺序的张量列表，供 update_targets 一次性批量拷贝
+        self._policy_param_list = list(self.policy_params.values())
+        self._target_param_list = [self.target_params[k] for k in self.policy_params]
+
+        # base_net 只作为 functional_call 的“骨架”，放在 meta 设备上不占内存
+        self.base_net = copy.deepcopy(policy_models[0]).to('meta')
+        # 对堆叠参数做 vmap：一次调用得到所有智能体的 Q 值 [num_agents, batch, action_dim]
+        self.net_call = torch.vmap(functional_call, in_dims=(None, 0, 0))
+
+        # Adam 是逐元素更新的，对堆叠参数用一个优化器等价于每个智能体各自一个
+        self.optimizer = optim.Adam(self._policy_param_list, lr=lr)
+
+        # 前向+损失部分用 torch.compile（inductor）编译；优化器 step 仍在编译区域之外。
+        # reduce-overhead 即 CUDA graph，只在 GPU 上有意义
+        if use_compile is None:
+            use_compile = self.device.type == 'cuda'
+        self._compiled = bool(use_compile)
+        self._train_step = self._loss_step
+        if self._compiled:
+            mode = 'reduce-overhead' if self.device.type == 'cuda' else 'default'
+            self._train_step = torch.compile(self._loss_step, mode=mode)
+        self.replay_buffer = ReplayBuffer(buffer_capacity, num_agents, state_dim, device=self.device)
+
+        # optimize_agents 每次用到的采样张量形状固定，预分配后反复写入，避免每步重新分配
+        # （actions / rewards / dones 直接是 [A, B, 1]，省去 unsqueeze）
+        self._sample_bufs = self.replay_buffer.empty_batch(batch_size)
+        self._buf_target_q = torch.empty((num_agents, batch_size, 1), dtype=torch.float32, device=self.device)
+        # 编译模式下目标 Q 由 inductor 自行分配/融合，写入外部缓冲反而会打断 CUDA graph
+        self._target_out = None if self._compiled else self._buf_target_q
+
+        # 使用 GPU 时，每步的观测先写入锁页内存，再异步拷贝到 device
+        self._state_staging = None
+        if self.device.type == 'cuda':
+            self._state_staging = torch.empty((env.num_envs, num_agents, state_dim),
+                                              dtype=torch.float32, pin_memory=True)
 
         self.steps_done = 0
 
         # 新增：用于记录loss和碰撞次数的容器
-        self.loss_history = {i: [] for i in range(num_agents)}  # 每个agent的loss历史
+        # 每个并行环境、每个agent自本回合开始以来的loss累加和（[K, A]）与更新次数（[K]），
+        # 用于 O(1) 求各回合的平均loss；loss 累加和留在 device 上，避免每次更新都同步回主机
+        self._loss_sum = torch.zeros((env.num_envs, num_agents), dtype=torch.float64, device=self.device)
+        self._loss_n = np.zeros(env.num_envs, dtype=np.int64)
         self.collision_history = []  # 每回合的碰撞次数
-        self.episode_collisions = 0  # 当前回合的碰撞计数
+        self.episode_collisions = np.zeros(env.num_envs, dtype=np.int64)  # 各并行环境当前回合的碰撞计数
 
-    def select_action(self, agent_id, state, eps, done):
+    def select_actions_batch(self, states, dones, eps):
         """
-        ε-贪心策略选择动作
-        state: numpy 数组
+        ε-贪心策略批量选择动作：一次 vmap 前向得到所有环境、所有智能体的 Q 值，
+        argmax 与随机探索都在 device 上完成
+        states: numpy 数组 [K, N, state_dim]
+        dones: bool 数组 [K, N]，为 True 的智能体已到达目标，固定选择停留
+        返回 numpy 数组 [K, N]
         """
-        if done:
-            return 4  # 已经到达目标后持续停留
-
-        if random.random() < eps:
-            return random.randint(0, self.action_dim - 1)
-        else:
-            state_tensor = torch.from_numpy(state).unsqueeze(0)  # shape [1, state_dim]
-            with torch.no_grad():
-                q_values = self.policy_nets[agent_id](state_tensor)
-            return int(q_values.argmax().item())
-
-    def optimize_agent(self, agent_id):
+        states_t = self._states_to_device(states).transpose(0, 1)  # [N, K, state_dim]
+        with torch.no_grad():
+            q_values = self.net_call(self.base_net, self.policy_params, (states_t,))  # [N, K, action_dim]
+        greedy = q_values.argmax(-1).T  # [K, N]
+
+        # 以 ε 概率随机探索，其余取贪心动作
+        rand_actions = torch.randint(0, self.action_dim, greedy.shape, device=self.device)
+        explore = torch.rand(greedy.shape, device=self.device) < eps
+        actions = torch.where(explore, rand_actions, greedy)
+
+        # 整个 [K, N] 动作张量只在这里同步回主机一次（env 的 numba kernel 需要 numpy）；
+        # dones 本来就在主机上，停留动作在拷回之后再覆盖，省去一次主机到设备的拷贝
+        actions = actions.cpu().numpy()
+        actions[dones] = 4  # 已经到达目标后持续停留
+        return actions
+
+    def _states_to_device(self, states):
+        """把 env 给出的 numpy state 拷贝到训练设备上"""
+        if self._state_staging is None:
+            return torch.from_numpy(states)
+        self._state_staging.numpy()[...] = states
+        return self._state_staging.to(self.device, non_blocking=True)
+
+    def _loss_step(self, states, actions, rewards, next_states, not_dones):
         """
-        对单个智能体进行 DQN 更新
+        计算每个智能体的 TD 损失，返回形状 [A]。not_dones 为 1 - dones。
+        只包含张量运算，便于 torch.compile 把两次前向、gather、max 与损失融合成少数几个 kernel。
         """
-        buffer = self.replay_buffers[agent_id]
-        if len(buffer) < self.batch_size:
-            return None  # 返回None表示没有更新
-
-        states, actions, rewards, next_states, dones = buffer.sample(self.batch_size)
-
-        # 转换为张量
-        states = torch.from_numpy(states)              # [batch, state_dim]
-        actions = torch.from_numpy(actions).unsqueeze(1).long()  # 转成 long (int64)
-        rewards = torch.from_numpy(rewards).unsqueeze(1)   # [batch, 1]
-        next_states = torch.from_numpy(next_states)    # [batch, state_dim]
-        dones = torch.from_numpy(dones.astype(np.uint8)).unsqueeze(1)  # [batch, 1]
-
         # 计算当前 Q(s,a)
-        current_q = self.policy_nets[agent_id](states).gather(1, actions)
+        current_q = self.net_call(self.base_net, self.policy_params, (states,)).gather(-1, actions)
 
         # 计算目标 Q 值：r + γ * max_a' Q_target(next_s, a')
         with torch.no_grad():
-            next_q = self.target_nets[agent_id](next_states).max(1)[0].unsqueeze(1)
-            target_q = rewards + (self.gamma * next_q * (1 - dones))
+            next_q = self.net_call(self.base_net, self.target_params, (next_states,)).max(-1, keepdim=True)[0]
+            target_q = torch.addcmul(rewards, next_q, not_dones, value=self.gamma, out=self._target_out)
+
+        # 每个智能体各自的 TD 误差损失，求和后各自参数得到的梯度与独立更新时相同
+        return self.loss_fn(current_q, target_q, reduction='none').mean(dim=(1, 2))
+
+    def optimize_agents(self):
+        """
+        对所有智能体做一次批量 DQN 更新：回放缓冲直接给出 [A, B, ...] 的样本，
+        通过 vmap 一次完成 N 个网络的前向与反向
+        """
+        if len(self.replay_buffer) < self.batch_size:
+            return None  # 返回None表示没有更新
 
-        # MSE 误差
-        criterion = nn.MSELoss()
-        loss = criterion(current_q, target_q)
+        # 采样结果直接写入预分配的缓冲区
+        states, actions, rewards, next_states, not_dones = self.replay_buffer.sample(
+            self.batch_size, out=self._sample_bufs)
+        not_dones.neg_().add_(1)  # 原地把 dones 变成 1 - dones
+
+        # 前向 + TD 目标 + 损失（可能已被 torch.compile 融合）
+        try:
+            agent_losses = self._train_step(states, actions, rewards, next_states, not_dones)  # [A]
+        except Exception as e:
+            if not self._compiled:
+                raise
+            # torch.compile 在第一次调用时才真正编译，缺少编译工具链等情况下在这里失败，退回 eager
+            print(f"torch.compile 失败，改用 eager 模式：{type(e).__name__}: {e}")
+            self._compiled = False
+            self._train_step = self._loss_step
+            self._target_out = self._buf_target_q
+            agent_losses = self._train_step(states, actions, rewards, next_states, not_dones)
+        loss = agent_losses.sum()
 
         # 反向传播并优化
-        self.optimizers[agent_id].zero_grad()
+        self.optimizer.zero_grad()
         loss.backward()
-        self.optimizers[agent_id].step()
+        self.optimizer.step()
 
-        # 在反向传播后记录loss
-        loss_value = loss.item()
-        self.loss_history[agent_id].append(loss_value)
-    
-        return loss_value  # 返回loss值
+        # 在反向传播后记录每个agent的loss（计入所有并行环境当前的回合）
+        self._loss_sum += agent_losses.detach()
+        self._loss_n += 1
+
+        return agent_losses.detach()  # 返回各agent的loss值
 
     def update_targets(self):
         """
         将 policy 网络的权重复制到 target 网络
         """
-        for i in range(self.num_agents):
-            self.target_nets[i].load_state_dict(self.policy_nets[i].state_dict())
+        with torch.no_grad():
+            torch._foreach_copy_(self._target_param_list, self._policy_param_list)
+
+    @staticmethod
+    def _ma(x, w):
+        """窗口为 w 的滑动平均（等价于 np.convolve(..., mode='valid')），用前缀和 O(N) 计算"""
+        c = np.concatenate(([0.0], np.cumsum(x, dtype=np.float64)))
+        return (c[w:] - c[:-w]) / w
 
     def _plot_training_stats(self, returns, losses, collisions):
         """绘制训练统计图：回报、loss和碰撞次数"""
@@ -430,9 +628,9 @@ class MADQNTrainer:
     
         # 计算移动平均（窗口大小为10）
         window_size = 10
-        returns_smooth = np.convolve(returns, np.ones(window_size)/window_size, mode='valid')
-        losses_smooth = np.convolve([x for x in losses if x > 0], np.ones(window_size)/window_size, mode='valid')
-        collisions_smooth = np.convolve(collisions, np.ones(window_size)/window_size, mode='valid')
+        returns_smooth = self._ma(returns, window_size)
+        losses_smooth = self._ma([x for x in losses if x > 0], window_size)
+        collisions_smooth = self._ma(collisions, window_size)
     
         # 1. 回报曲线（原始数据+平滑曲线）
         plt.subplot(1, 3, 1)
@@ -473,13 +671,23 @@ class MADQNTrainer:
 
 
     def train(self, num_episodes=200, max_steps=50,
-              eps_start=1.0, eps_end=0.05, eps_decay=0.995):
+              eps_start=1.0, eps_end=0.05, eps_decay=0.995, plot=True):
         """
         多智能体 DQN 训练函数（修正版）。主要改动点保持不变。
+        K 个并行环境同时推进；某个环境的回合结束后立即自动复位并记为一个 episode，
+        直到累计完成 num_episodes 个回合。
+        每推进一步做 K 次批量 DQN 更新，即每条环境 transition 对应一次更新（与单环境时相同），
+        这样每个回合平均经历的更新次数、以及按回合计的 ε 衰减和 target 同步间隔
+        都与 K=1 时保持一致。每回合的平均 loss 只统计该回合各步内发生的更新。
+        plot 为 False 时不绘制训练统计图。
         """
         eps = eps_start
         episode_returns = []
         avg_loss_history = []  # 新增：每回合平均loss
+        # 最近 10 回合的回报、loss、碰撞次数，用于收敛判断和打印
+        recent_returns = deque(maxlen=10)
+        recent_losses = deque(maxlen=10)
+        recent_collisions = deque(maxlen=10)
 
         # 新增：收敛评估变量
         start_time = time.time()  # 记录训练开始时间
@@ -487,101 +695,116 @@ class MADQNTrainer:
         convergence_threshold = 0.9  # 定义收敛阈值（可根据实际情况调整）
         max_return = 0  # 记录最大回报
 
-        for episode in range(1, num_episodes + 1):
-            # 重置环境，并初始化 done_dict
-            obs = self.env.reset()
-            state_dict = obs_to_state(obs, self.env.grid_size)
-            done_dict = {i: False for i in range(self.num_agents)}
-            total_reward = 0
-            self.episode_collisions = 0  # 重置碰撞计数器
-
-            for step in range(max_steps):
-                actions = {}
-                # ε-贪心选动作，若 done_dict[i]==True，则 select_action 会返回 4（stay）
-                for i in range(self.num_agents):
-                    actions[i] = self.select_action(i, state_dict[i], eps, done_dict[i])
-
-                # 与环境交互
-                next_obs, rewards, done_all, _, num_collisions = self.env.step(actions)
-                self.episode_collisions += num_collisions
-                next_state_dict = obs_to_state(next_obs, self.env.grid_size)
-
-                # 存储 transition、更新 done_dict
-                for i in range(self.num_agents):
-                    # 存储的是“执行动作之前”的 done 状态
-                    self.replay_buffers[i].push(
-                        state_dict[i],
-                        actions[i],
-                        rewards[i],
-                        next_state_dict[i],
-                        done_dict[i]
-                    )
-
-                    # 如果这一步 reward == +10，说明 i 刚刚到达目标，标记 done=True
-                    if rewards[i] == 10:
-                        done_dict[i] = True
-
-                    total_reward += rewards[i]
-
-                state_dict = next_state_dict
-
-                # 对每个 Agent 做一次 DQN 更新
-                for i in range(self.num_agents):
-                    self.optimize_agent(i)
-
-                # 如果所有 Agent 都到达，或者步数上限，结束本回合
-                if done_all:
+        # 重置所有环境，并初始化 done_mask（形状 [K, N]）
+        # env 返回的 state 是其内部缓冲区，存入回放缓冲前先 copy 一份
+        K = self.env.num_envs
+        states = self.env.reset().copy()
+        done_mask = np.zeros((K, self.num_agents), dtype=np.bool_)
+        total_rewards = np.zeros(K)  # 各环境当前回合的累计回报
+        episode_steps = np.zeros(K, dtype=np.int64)  # 各环境当前回合已走的步数
+        self.episode_collisions[:] = 0  # 重置碰撞计数器
+        episode = 0
+
+        while episode < num_episodes:
+            # ε-贪心选动作，若 done_mask[k, i]==True，则返回 4（stay）
+            actions = self.select_actions_batch(states, done_mask, eps)
+
+            # 与环境交互，已结束的环境会被自动复位
+            next_obs, rewards, done_env, info, num_collisions = self.env.step(actions, autoreset=True)
+            self.episode_collisions += num_collisions
+            episode_steps += 1
+            # 存入回放缓冲的 next_state 必须是复位前的最终观测
+            next_states = info['final_states'] if 'final_states' in info else next_obs.copy()
+
+            # 存储 transition（存储的是“执行动作之前”的 done 状态），K 个环境一次写入
+            self.replay_buffer.push(states, actions, rewards, next_states, done_mask)
+
+            # 如果这一步 reward == +10，说明该智能体刚刚到达目标，标记 done=True
+            done_mask |= (rewards == 10)
+            total_rewards += rewards.sum(axis=1)
+
+            # 每条 transition 对应一次批量 DQN 更新：K 个环境各推进一步，共做 K 次
+            for _ in range(K):
+                self.optimize_agents()
+
+            # 所有 Agent 都到达或达到环境步数上限的环境已自动复位；
+            # 达到 max_steps 但环境尚未结束的，在这里手动复位
+            truncated = (episode_steps >= max_steps) & ~done_env
+            if truncated.any():
+                next_obs = self.env.reset(truncated)
+            finished = done_env | truncated
+            states = next_obs.copy() if finished.any() else next_states
+
+            finished_idx = np.flatnonzero(finished)
+            if len(finished_idx):
+                # 取出本步结束的各环境自回合开始以来的 loss 累加和，随后只清空这些环境的累加器
+                loss_sum = self._loss_sum.cpu().numpy().copy()  # CPU 上 .numpy() 与原张量共享内存
+                loss_n = self._loss_n.copy()
+                self._loss_sum.index_fill_(0, torch.as_tensor(finished_idx, device=self.device), 0)
+                self._loss_n[finished_idx] = 0
+
+            for k in finished_idx:
+                episode += 1
+                total_reward = total_rewards[k]
+
+                # 在回合结束后记录数据
+                episode_returns.append(total_reward)
+                self.collision_history.append(int(self.episode_collisions[k]))
+                recent_returns.append(total_reward)
+                recent_collisions.append(int(self.episode_collisions[k]))
+
+                # 清空该环境的回合统计，开始新回合
+                total_rewards[k] = 0
+                episode_steps[k] = 0
+                self.episode_collisions[k] = 0
+                done_mask[k] = False
+
+                # 更新最大回报
+                if total_reward > max_return:
+                    max_return = total_reward
+
+                # 检查是否收敛（连续10回合平均回报达到最大可能回报的90%）
+                if len(recent_returns) == 10 and convergence_episode is None:
+                    recent_avg = sum(recent_returns) / len(recent_returns)
+                    if recent_avg >= max_return * convergence_threshold:
+                        convergence_episode = episode
+                        convergence_time = time.time() - start_time
+
+                # 记录本回合的平均loss（各agent取平均；本回合内没有更新过则记为 0）
+                avg_loss = loss_sum[k].mean() / loss_n[k] if loss_n[k] > 0 else 0.0
+                avg_loss_history.append(avg_loss)
+                recent_losses.append(avg_loss)
+
+                # ε 衰减（闭式：eps_start * eps_decay^episode，下限 eps_end）
+                eps = max(eps_end, eps_start * eps_decay ** episode)
+
+                # 周期性地同步 target 网络
+                if episode % self.target_update == 0:
+                    self.update_targets()
+
+                # 每10回合打印一次平均回报、loss和碰撞次数
+                if episode % 10 == 0:
+                    last10_avg = sum(recent_returns) / len(recent_returns)
+                    last10_loss = sum(recent_losses) / len(recent_losses)
+                    last10_coll = sum(recent_collisions) / len(recent_collisions)
+                    print(f"Episode {episode}/{num_episodes}, "
+                          f"Epsilon: {eps:.3f}, "
+                          f"AvgReturn(last10): {last10_avg:.2f}, "
+                          f"AvgLoss(last10): {last10_loss:.4f}, "
+                          f"AvgCollisions(last10): {last10_coll:.1f}")
+
+                if episode >= num_episodes:
                     break
 
-             # 在回合结束后记录数据
-            episode_returns.append(total_reward)
-            self.collision_history.append(self.episode_collisions)
-
-            # 更新最大回报
-            if total_reward > max_return:
-                max_return = total_reward
-        
-            # 检查是否收敛（连续10回合平均回报达到最大可能回报的90%）
-            if len(episode_returns) >= 10 and convergence_episode is None:
-                recent_avg = np.mean(episode_returns[-10:])
-                if recent_avg >= max_return * convergence_threshold:
-                    convergence_episode = episode
-                    convergence_time = time.time() - start_time
-        
-            # 计算本回合的平均loss
-            episode_losses = []
-            for i in range(self.num_agents):
-                if self.loss_history[i]:  # 只取本回合的loss
-                    episode_losses.append(np.mean(self.loss_history[i][-max_steps:]))
-            avg_loss = np.mean(episode_losses) if episode_losses else 0.0
-            avg_loss_history.append(avg_loss)
-
-            # ε 衰减
-            eps = max(eps * eps_decay, eps_end)
-
-            # 周期性地同步 target 网络
-            if episode % self.target_update == 0:
-                self.update_targets()
-
-            # 每10回合打印一次平均回报、loss和碰撞次数
-            if episode % 10 == 0:
-                last10_avg = np.mean(episode_returns[-10:])
-                last10_loss = np.mean(avg_loss_history[-10:])
-                last10_coll = np.mean(self.collision_history[-10:])
-                print(f"Episode {episode}/{num_episodes}, "
-                      f"Epsilon: {eps:.3f}, "
-                      f"AvgReturn(last10): {last10_avg:.2f}, "
-                      f"AvgLoss(last10): {last10_loss:.4f}, "
-                      f"AvgCollisions(last10): {last10_coll:.1f}")
-
         # 训练完成后输出收敛评估结果,绘制统计图
         if convergence_episode is not None:
             print(f"\n算法在 {convergence_episode} 轮后收敛，花费时间: {convergence_time:.2f} 秒")
-            print(f"最终10轮平均回报: {np.mean(episode_returns[-10:]):.2f}")
+            print(f"最终10轮平均回报: {sum(recent_returns) / len(recent_returns):.2f}")
         else:
             print("\n算法在指定轮数内未达到收敛标准")
-            print(f"最终10轮平均回报: {np.mean(episode_returns[-10:]):.2f}")
-        self._plot_training_stats(episode_returns, avg_loss_history, self.collision_history)
+            print(f"最终10轮平均回报: {sum(recent_returns) / len(recent_returns):.2f}")
+        if plot:
+            self._plot_training_stats(episode_returns, avg_loss_history, self.collision_history)
     
         return episode_returns
 
@@ -589,19 +812,19 @@ class MADQNTrainer:
 
 
 
-def animate(trainer, env):
+def animate(trainer, env, show=True):
     """
     可视化函数：动画展示贪心策略下的多智能体轨迹，
     从第一步开始逐步显示每个智能体的移动过程，
     障碍物绘制为填满整个格子，并在图例中说明起点、终点和障碍物的形状。
+    show=False 时不弹出窗口（不会阻塞），只把动画保存为 GIF。
     """
     H, W = env.grid_size
     agent_trajectories = {i: [] for i in range(env.num_agents)}
-    done_dict = {i: False for i in range(env.num_agents)}
+    done_mask = np.zeros((env.num_envs, env.num_agents), dtype=np.bool_)
 
     # 重置环境并记录初始位置
-    obs = env.reset()
-    state_dict = obs_to_state(obs, env.grid_size)
+    states = env.reset()
     for i in range(env.num_agents):
         agent_trajectories[i].append(env.agent_positions[i])
 
@@ -611,21 +834,18 @@ def animate(trainer, env):
     done = False
     
     while not done and step < 50:
-        actions = {
-            i: trainer.select_action(i, state_dict[i], eps=0.0, done=done_dict[i])
-            for i in range(env.num_agents)
-        }
-        next_obs, rewards, done, _, num_collisions = env.step(actions)
-        next_state_dict = obs_to_state(next_obs, env.grid_size)
+        # 贪心策略下所有并行环境的轨迹相同，这里只展示第 0 个环境
+        actions = trainer.select_actions_batch(states, done_mask, eps=0.0)
+        states, rewards, done, _, num_collisions = env.step(actions)
+        done = done[0]
         
         for i in range(env.num_agents):
-            if rewards[i] == 10 or env.agent_positions[i] == env.destinations[i]:
-                done_dict[i] = True
+            if rewards[0, i] == 10 or env.agent_positions[i] == env.destinations[i]:
+                done_mask[:, i] = True
             agent_trajectories[i].append(env.agent_positions[i])
         
         # 记录当前步骤的所有智能体位置
         all_steps.append({i: env.agent_positions[i] for i in range(env.num_agents)})
-        state_dict = next_state_dict
         step += 1
 
     print("Final Greedy Trajectories (row, col) for each agent:")
@@ -744,7 +964,8 @@ def animate(trainer, env):
     )
 
     plt.tight_layout()
-    plt.show()
+    if show:
+        plt.show()
     
     # 保存为GIF
     ani.save('animate_results/greedy_trajectories_DQNObstacle.gif', writer='pillow', fps=2, dpi=100)
@@ -755,6 +976,11 @@ def animate(trainer, env):
 # 第三部分：执行训练（示例：定义一些固定障碍物）
 # ----------------------------------------
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="带障碍物的多智能体 DQN 交通路径规划")
+    parser.add_argument('--no-plot', dest='plot', action='store_false',
+                        help="只训练，不绘制统计图、不生成贪心策略动画")
+    args = parser.parse_args()
+
     # 在 8x8 网格中，定义几个固定障碍物坐标
     fixed_obstacles = [
         (1, 1),
@@ -771,7 +997,8 @@ if __name__ == "__main__":
     env = TrafficRoutingEnv(
         grid_size=(GRID_ROWS, GRID_COLS),
         num_agents=NUM_AGENTS,
-        obstacles=fixed_obstacles
+        obstacles=fixed_obstacles,
+        num_envs=NUM_ENVS
     )
 
     state_dim = 14   # 因为我们用 4+9+1 的状态向量
@@ -786,8 +1013,9 @@ if __name__ == "__main__":
 
     # 进行训练
     #episode_returns = trainer.train(num_episodes=NUM_EPISODES)
-    trainer.train(num_episodes=NUM_EPISODES)
+    trainer.train(num_episodes=NUM_EPISODES, plot=args.plot)
 
     # 训练结束后可视化（贪心策略）
     #plot_greedy_trajectories(trainer, env)
-    animate(trainer, env)
+    if args.plot:
+        animate(trainer, env)